@@ -10,12 +10,17 @@ from __future__ import print_function
 
 import os
 import sys
-import yaml
+from fractions import Fraction
+from functools import lru_cache
 
 import numpy as np
 from easydict import EasyDict as edict
 
 
+def _as_int_pair(v):
+    # Sizes are canonically a length-2 int array; a scalar means square
+    return np.asarray([v, v] if isinstance(v, int) else v, dtype=np.int32)
+
 config = edict()
 
 config.OUTPUT_DIR = ""
@@ -43,7 +48,7 @@ POSE_RESNET.NUM_DECONV_FILTERS = [256, 256, 256]
 POSE_RESNET.NUM_DECONV_KERNELS = [4, 4, 4]
 POSE_RESNET.FINAL_CONV_KERNEL = 1
 POSE_RESNET.TARGET_TYPE = "gaussian"
-POSE_RESNET.HEATMAP_SIZE = [64, 64]  # width * height, ex: 24 * 32
+POSE_RESNET.HEATMAP_SIZE = _as_int_pair([64, 64])  # width * height, ex: 24 * 32
 POSE_RESNET.SIGMA = 2
 
 # pose_resnet related params
@@ -65,13 +70,15 @@ MODEL_EXTRAS = {
 config.MODEL = edict()
 config.MODEL.MERGE_MODE = "concat"
 config.MODEL.CASCADED = False
+config.MODEL.ENABLE_AMP = False  # bfloat16 autocast in the hourglass forward
+config.MODEL.COMPILE = False  # torch.compile the hourglass model
 config.MODEL.NAME = "pose_resnet"  # "pose_resnet", "unet"
 config.MODEL.INIT_WEIGHTS = False
 config.MODEL.PRETRAINED = ""
 config.MODEL.TEACHER_CFG = ""
 config.MODEL.NUM_JOINTS = 16
 config.MODEL.NUM_CHANNELS = 144  # 144, 256
-config.MODEL.IMAGE_SIZE = [256, 256]  # width * height, ex: 192 * 256
+config.MODEL.IMAGE_SIZE = _as_int_pair([256, 256])  # width * height, ex: 192 * 256
 config.MODEL.EXTRA = MODEL_EXTRAS[config.MODEL.NAME]
 
 config.MODEL.STYLE = "pytorch"
@@ -91,6 +98,7 @@ config.DATASET.TEST_SET = "valid"
 config.DATASET.DATA_FORMAT = "jpg"
 config.DATASET.HYBRID_JOINTS_TYPE = ""
 config.DATASET.SELECT_DATA = False
+config.DATASET.USE_DALI = False  # decode and augment training images on the GPU
 
 # training data augmentation
 config.DATASET.FLIP = True
@@ -119,6 +127,10 @@ config.TRAIN.CHECKPOINT = ""
 
 config.TRAIN.BATCH_SIZE = 32
 config.TRAIN.SHUFFLE = True
+config.TRAIN.ACCUM_STEPS = 1  # micro-batches per optimizer step
+config.TRAIN.AMP_DTYPE = ""  # float16, bfloat16; empty trains in float32
+config.TRAIN.CUDA_GRAPH = False  # replay the training step as a CUDA graph
+config.TRAIN.COMPILE = False  # torch.compile the DDP model and loss for training
 
 # testing
 config.TEST = edict()
@@ -149,59 +161,105 @@ config.DEBUG.SAVE_HEATMAPS_GT = False
 config.DEBUG.SAVE_HEATMAPS_PRED = False
 
 
-def _update_dict(k, v):
+def _to_floats(seq):
+    # Fraction parses plain numbers as well as ratios such as "1/255"
+    return np.asarray([float(Fraction(x)) if isinstance(x, str) else float(x)
+                       for x in seq], dtype=np.float32)
+
+
+def _normalize_section(k, v):
     if k == "DATASET":
         if "MEAN" in v and v["MEAN"]:
-            v["MEAN"] = np.array([eval(x) if isinstance(x, str) else x
-                                  for x in v["MEAN"]])
+            v["MEAN"] = _to_floats(v["MEAN"])
         if "STD" in v and v["STD"]:
-            v["STD"] = np.array([eval(x) if isinstance(x, str) else x
-                                 for x in v["STD"]])
+            v["STD"] = _to_floats(v["STD"])
     if k == "MODEL":
         if "EXTRA" in v and "HEATMAP_SIZE" in v["EXTRA"]:
-            if isinstance(v["EXTRA"]["HEATMAP_SIZE"], int):
-                v["EXTRA"]["HEATMAP_SIZE"] = np.array(
-                    [v["EXTRA"]["HEATMAP_SIZE"], v["EXTRA"]["HEATMAP_SIZE"]])
-            else:
-                v["EXTRA"]["HEATMAP_SIZE"] = np.array(
-                    v["EXTRA"]["HEATMAP_SIZE"])
+            v["EXTRA"]["HEATMAP_SIZE"] = _as_int_pair(v["EXTRA"]["HEATMAP_SIZE"])
         if "IMAGE_SIZE" in v:
-            if isinstance(v["IMAGE_SIZE"], int):
-                v["IMAGE_SIZE"] = np.array([v["IMAGE_SIZE"], v["IMAGE_SIZE"]])
-            else:
-                v["IMAGE_SIZE"] = np.array(v["IMAGE_SIZE"])
-    for vk, vv in v.items():
-        if vk in config[k]:
-            config[k][vk] = vv
+            v["IMAGE_SIZE"] = _as_int_pair(v["IMAGE_SIZE"])
+
+
+def _collect_updates(exp_config):
+    # Flatten into (target, key, value) triples, raising on unknown keys
+    # before anything is written to config
+    updates = []
+    for k, v in exp_config.items():
+        if k not in config:
+            raise ValueError(f"{k} not exist in config.py")
+        if isinstance(v, dict):
+            _normalize_section(k, v)
+            for vk, vv in v.items():
+                if vk not in config[k]:
+                    raise ValueError(f"{k}.{vk} not exist in config.py")
+                updates.append((config[k], vk, vv))
+        elif k == "SCALES":
+            updates.append((config[k], 0, tuple(v)))
         else:
-            raise ValueError(f"{k}.{vk} not exist in config.py")
+            updates.append((config, k, v))
+    return updates
 
 
-def update_config(config_file):
-    exp_config = None
+def _to_dict(v):
+    # The safe dumper only represents plain containers
+    if isinstance(v, dict):
+        return {k: _to_dict(vv) for k, vv in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_to_dict(vv) for vv in v]
+    if hasattr(v, "tolist"):  # numpy arrays and scalars
+        return v.tolist()
+    return v
+
+
+def _load_yaml(f):
+    import yaml
+
+    # Prefer the libyaml-backed loader when available
+    return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _load_exp_config(config_file):
+    # Opt-in mtime-keyed pickle cache next to the yaml file
+    if os.environ.get("TDPOSE_YAML_CACHE") != "1":
+        with open(config_file) as f:
+            return _load_yaml(f)
+
+    import pickle
+
+    cache_file = config_file + ".pkl"
+    if os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(config_file):
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # A corrupt or stale-format cache is rebuilt below
+            pass
+
     with open(config_file) as f:
-        exp_config = edict(yaml.load(f))
-        for k, v in exp_config.items():
-            if k in config:
-                if isinstance(v, dict):
-                    _update_dict(k, v)
-                else:
-                    if k == "SCALES":
-                        config[k][0] = (tuple(v))
-                    else:
-                        config[k] = v
-            else:
-                raise ValueError(f"{k} not exist in config.py")
+        exp_config = _load_yaml(f)
+    # Sweeps run many processes at once; write under a per-process name
+    # and swap it in so readers never see a partial pickle
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, "wb") as f:
+        pickle.dump(_to_dict(exp_config), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return exp_config
+
+
+def update_config(config_file):
+    exp_config = edict(_load_exp_config(config_file))
+    for target, key, value in _collect_updates(exp_config):
+        target[key] = value
 
 
 def gen_config(config_file):
-    cfg = dict(config)
-    for k, v in cfg.items():
-        if isinstance(v, edict):
-            cfg[k] = dict(v)
+    import yaml
 
+    cfg = _to_dict(config)
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
     with open(config_file, "w") as f:
-        yaml.dump(dict(cfg), f, default_flow_style=False)
+        yaml.dump(cfg, f, Dumper=dumper, default_flow_style=False)
 
 
 def update_dir(model_dir, log_dir, data_dir):
@@ -224,25 +282,38 @@ def update_dir(model_dir, log_dir, data_dir):
             config.DATA_DIR, config.MODEL.PRETRAINED)
 
 
-def get_model_name(cfg):
-    name = cfg.MODEL.NAME
-    extra = cfg.MODEL.EXTRA
+@lru_cache(maxsize=None)
+def _model_name_cached(name, num_layers, n_hg_stacks, cascaded, td_lambda,
+                       cascaded_scheme):
     if "pose_resnet" in name:
-        name = f"pose_resnet_{extra.NUM_LAYERS}"
+        name = f"pose_resnet_{num_layers}"
     elif name == "unet":
-        name = f"unet_x{extra.N_HG_STACKS}"
+        name = f"unet_x{n_hg_stacks}"
     elif name == "pose_stacked_hg":
-        name = f"hourglass_x{extra.N_HG_STACKS}"
+        name = f"hourglass_x{n_hg_stacks}"
     else:
         raise ValueError(f"Unkown model: {name}")
     
-    if cfg.MODEL.CASCADED:
-        suffix = f"cascaded_td({cfg.LOSS.TD_LAMBDA})"
-        suffix += f"__{extra.CASCADED_SCHEME}"
+    if cascaded:
+        suffix = f"cascaded_td({td_lambda})"
+        suffix += f"__{cascaded_scheme}"
         name = f"{name}__{suffix}"
     full_name = f"{name}"
     return name, full_name
 
 
+def get_model_name(cfg):
+    # cfg is an unhashable edict, so cache on the scalar fields it uses
+    extra = cfg.MODEL.EXTRA
+    return _model_name_cached(
+        cfg.MODEL.NAME,
+        extra.get("NUM_LAYERS"),
+        extra.get("N_HG_STACKS"),
+        cfg.MODEL.CASCADED,
+        cfg.LOSS.TD_LAMBDA,
+        extra.get("CASCADED_SCHEME"),
+    )
+
+
 if __name__ == "__main__":
     gen_config(sys.argv[1])
@@ -49,7 +49,9 @@ def train(
     # measure data loading time
     data_time.update(time.time() - end)
 
-    # Set target weight
+    # Copy the pinned batch over once, asynchronously; the teacher and the
+    # student would otherwise each scatter it from host memory
+    input = input.cuda(non_blocking=True)
     target = target.cuda(non_blocking=True)
     target_weight = target_weight.cuda(non_blocking=True)
     
@@ -64,9 +66,11 @@ def train(
     loss = criterion(outputs, teacher_output, target, target_weight)
 
     # compute gradient and do update step
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
     loss.backward()
     optimizer.step()
+    # The cached replicas still hold the pre-step weights
+    model.update_replicates()
 
     # measure accuracy and record loss
     losses.update(loss.item(), input.size(0))
@@ -127,7 +131,8 @@ def validate(
     scale = meta['scale'].numpy()
     score = meta['score'].numpy()
 
-    # Set target and target_weight device
+    # Set input, target and target_weight device
+    input = input.cuda(non_blocking=True)
     target = target.cuda(non_blocking=True)
     target_weight = target_weight.cuda(non_blocking=True)
 
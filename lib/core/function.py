@@ -8,6 +8,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import logging
 import time
 import os
@@ -26,7 +27,14 @@ from utils.vis import save_debug_images
 logger = logging.getLogger(__name__)
 
 
-def train(config, train_loader, model, criterion, optimizer, epoch, output_dir):
+def get_amp_dtype(config):
+    if config.TRAIN.AMP_DTYPE:
+        return getattr(torch, config.TRAIN.AMP_DTYPE)
+    return None
+
+
+def train(config, train_loader, model, criterion, optimizer, epoch, output_dir,
+          scaler=None, graphed_step=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -35,10 +43,20 @@ def train(config, train_loader, model, criterion, optimizer, epoch, output_dir):
         n_timesteps *= 2
     accs = [AverageMeter() for _ in range(n_timesteps)]
 
+    # Mixed precision; float16 also needs a GradScaler to avoid underflow
+    amp_dtype = get_amp_dtype(config)
+    use_amp = amp_dtype is not None
+
+    # Gradient accumulation; DDP's no_sync() defers the allreduce to the
+    # last micro-step of each group
+    accum_steps = config.TRAIN.ACCUM_STEPS
+    no_sync = getattr(model, 'no_sync', contextlib.nullcontext)
+
     # switch to train mode
     model.train()
     end = time.time()
 
+    optimizer.zero_grad(set_to_none=True)
     for i, (x_data, target, target_weight, meta) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
@@ -47,16 +65,38 @@ def train(config, train_loader, model, criterion, optimizer, epoch, output_dir):
         target = target.cuda(non_blocking=True)
         target_weight = target_weight.cuda(non_blocking=True)
 
-        # compute output
-        outputs = model(x_data)
-
-        # loss
-        loss = criterion(outputs, target, target_weight)
-
-        # compute gradient and do update step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if graphed_step is not None:
+            # forward, backward and update step in one graph replay
+            outputs, loss = graphed_step(x_data, target, target_weight)
+        else:
+            update = (i + 1) % accum_steps == 0 or i + 1 == len(train_loader)
+            # forward runs under no_sync() too, so DDP doesn't prepare
+            # a reduction for the backward
+            sync_ctx = contextlib.nullcontext() if update else no_sync()
+            with sync_ctx:
+                with torch.autocast(device_type='cuda', dtype=amp_dtype,
+                                    enabled=use_amp):
+                    # compute output
+                    outputs = model(x_data)
+
+                    # loss
+                    loss = criterion(outputs, target, target_weight)
+
+                # compute gradient
+                scaled_loss = loss / accum_steps
+                if scaler is not None:
+                    scaler.scale(scaled_loss).backward()
+                else:
+                    scaled_loss.backward()
+
+            # do update step
+            if update:
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
 
         # measure accuracy and record loss
         losses.update(loss.item(), x_data.size(0))
@@ -115,7 +155,9 @@ def validate(config, val_loader, val_dataset, model, criterion, output_dir):
         scale = meta['scale'].numpy()
         score = meta['score'].numpy()
 
-        # Set target and target_weight device
+        # Set input, target and target_weight device; the model may be
+        # unwrapped, so the input is not necessarily scattered for us
+        x_data = x_data.cuda(non_blocking=True)
         target = target.cuda(non_blocking=True)
         target_weight = target_weight.cuda(non_blocking=True)
 
@@ -264,3 +306,82 @@ class AverageMeter(object):
         self.sum += val * n
         self.count += n
         self.avg = self.sum / self.count if self.count != 0 else 0
+
+
+class GraphedTrainStep(object):
+    """Captures one training step as a CUDA graph and replays it
+
+    Batches whose shapes differ from the captured batch (e.g. the last,
+    partial one) run eagerly. The graph is re-captured when the learning
+    rate changes, since the captured optimizer step bakes it in. The model
+    and criterion must not sync with the host (no .item() or .cpu()),
+    which capture forbids.
+    """
+    def __init__(self, model, criterion, optimizer, amp_dtype=None,
+                 warmup_steps=11):
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.amp_dtype = amp_dtype
+        # DDP needs several eager iterations before it can be captured
+        self.warmup_steps = warmup_steps
+
+        self.graph = None
+        self.n_eager = 0
+        self.stream = torch.cuda.Stream()
+
+    def _lrs(self):
+        return [group['lr'] for group in self.optimizer.param_groups]
+
+    def _step(self, x_data, target, target_weight):
+        with torch.autocast(device_type='cuda', dtype=self.amp_dtype,
+                            enabled=self.amp_dtype is not None,
+                            cache_enabled=False):
+            outputs = self.model(x_data)
+            loss = self.criterion(outputs, target, target_weight)
+        loss.backward()
+        self.optimizer.step()
+        return outputs, loss
+
+    def _eager_step(self, x_data, target, target_weight):
+        # Warmup must run on a side stream before capture
+        self.optimizer.zero_grad(set_to_none=True)
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            outputs, loss = self._step(x_data, target, target_weight)
+        torch.cuda.current_stream().wait_stream(self.stream)
+        self.n_eager += 1
+        return outputs, loss
+
+    def _capture(self, x_data, target, target_weight):
+        self.static_inputs = (
+            x_data.to(target.device, copy=True),
+            target.clone(),
+            target_weight.clone(),
+        )
+        self.captured_lrs = self._lrs()
+
+        # Grads must be allocated inside the graph so replays overwrite them
+        self.optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_outputs, self.static_loss = self._step(
+                *self.static_inputs)
+
+    def __call__(self, x_data, target, target_weight):
+        if self.graph is not None and self.captured_lrs != self._lrs():
+            self.graph = None
+
+        if self.graph is None:
+            if self.n_eager < self.warmup_steps:
+                return self._eager_step(x_data, target, target_weight)
+            self._capture(x_data, target, target_weight)
+        elif x_data.shape != self.static_inputs[0].shape:
+            return self._eager_step(x_data, target, target_weight)
+
+        # Capture records the work without running it, so always replay
+        for static, batch in zip(self.static_inputs,
+                                 (x_data, target, target_weight)):
+            static.copy_(batch, non_blocking=True)
+        self.graph.replay()
+        return self.static_outputs, self.static_loss
@@ -53,7 +53,6 @@ class TDLambda_JointsMSELoss(nn.Module):
   def forward(self, predictions, target, target_weight=None):
     loss = 0
     n_timesteps = len(predictions)
-    timestep_losses = torch.zeros(n_timesteps)
     
     for t in range(len(predictions)):
       pred_i = predictions[t]
@@ -76,9 +75,6 @@ class TDLambda_JointsMSELoss(nn.Module):
       
       # Aggregate loss
       loss = loss + loss_i
-
-      # Log loss item
-      timestep_losses[t] = loss_i.item()
       
     # Normalize loss
 #     if self.normalize_loss:
@@ -9,6 +9,7 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import io
 import logging
 import random
 
@@ -64,8 +65,6 @@ class JointsDataset(Dataset):
         db_rec = copy.deepcopy(self.db[idx])
 
         image_file = db_rec['image']
-        filename = db_rec['filename'] if 'filename' in db_rec else ''
-        imgnum = db_rec['imgnum'] if 'imgnum' in db_rec else ''
 
         if self.data_format == 'zip':
             from utils import zipreader
@@ -79,13 +78,77 @@ class JointsDataset(Dataset):
             logger.error('=> fail to read {}'.format(image_file))
             raise ValueError('Fail to read {}'.format(image_file))
 
+        c, s, r, flipped, joints, joints_vis = self._augment(
+            db_rec, data_numpy.shape[1])
+        if flipped:
+            data_numpy = data_numpy[:, ::-1, :]
+
+        trans = get_affine_transform(c, s, r, self.image_size)
+        input = cv2.warpAffine(
+            data_numpy,
+            trans,
+            (int(self.image_size[0]), int(self.image_size[1])),
+            flags=cv2.INTER_LINEAR)
+
+        if self.transform:
+            input = self.transform(input)
+
+        target, target_weight, meta = self._make_targets(
+            db_rec, trans, c, s, r, joints, joints_vis)
+
+        target = torch.from_numpy(target)
+        target_weight = torch.from_numpy(target_weight)
+
+        return input, target, target_weight, meta
+
+    def get_encoded(self, idx):
+        """Like __getitem__, but leaves decoding and warping to the caller.
+
+        Returns the still-encoded image bytes and the 2x3 affine matrix
+        (flip included) that maps them onto the input crop, followed by
+        the target, target_weight, joints and joints_vis arrays.
+        """
+        from PIL import Image
+
+        if self.data_format == 'zip':
+            raise ValueError('get_encoded does not support zip data')
+
+        db_rec = copy.deepcopy(self.db[idx])
+
+        image_file = db_rec['image']
+        with open(image_file, 'rb') as f:
+            encoded = f.read()
+        # Only the header is parsed for the size
+        width = Image.open(io.BytesIO(encoded)).size[0]
+
+        c, s, r, flipped, joints, joints_vis = self._augment(db_rec, width)
+
+        # The joints are already mirrored, so only the image matrix folds
+        # in the flip that __getitem__ applies to the decoded image
+        trans = get_affine_transform(c, s, r, self.image_size)
+        image_trans = trans
+        if flipped:
+            flip = np.array([[-1, 0, width - 1], [0, 1, 0], [0, 0, 1]])
+            image_trans = trans.dot(flip)
+
+        target, target_weight, _ = self._make_targets(
+            db_rec, trans, c, s, r, joints, joints_vis)
+
+        return (np.frombuffer(encoded, dtype=np.uint8),
+                image_trans.astype(np.float32),
+                target,
+                target_weight,
+                joints.astype(np.float32),
+                joints_vis.astype(np.float32))
+
+    def _augment(self, db_rec, image_width):
         joints = db_rec['joints_3d']
         joints_vis = db_rec['joints_3d_vis']
 
         c = db_rec['center']
         s = db_rec['scale']
-        score = db_rec['score'] if 'score' in db_rec else 1
         r = 0
+        flipped = False
 
         if self.is_train:
             sf = self.scale_factor
@@ -95,43 +158,33 @@ class JointsDataset(Dataset):
                 if random.random() <= 0.6 else 0
 
             if self.flip and random.random() <= 0.5:
-                data_numpy = data_numpy[:, ::-1, :]
+                flipped = True
                 joints, joints_vis = fliplr_joints(
-                    joints, joints_vis, data_numpy.shape[1], self.flip_pairs)
-                c[0] = data_numpy.shape[1] - c[0] - 1
-
-        trans = get_affine_transform(c, s, r, self.image_size)
-        input = cv2.warpAffine(
-            data_numpy,
-            trans,
-            (int(self.image_size[0]), int(self.image_size[1])),
-            flags=cv2.INTER_LINEAR)
+                    joints, joints_vis, image_width, self.flip_pairs)
+                c[0] = image_width - c[0] - 1
 
-        if self.transform:
-            input = self.transform(input)
+        return c, s, r, flipped, joints, joints_vis
 
+    def _make_targets(self, db_rec, trans, c, s, r, joints, joints_vis):
         for i in range(self.num_joints):
             if joints_vis[i, 0] > 0.0:
                 joints[i, 0:2] = affine_transform(joints[i, 0:2], trans)
 
         target, target_weight = self.generate_target(joints, joints_vis)
 
-        target = torch.from_numpy(target)
-        target_weight = torch.from_numpy(target_weight)
-
         meta = {
-            'image': image_file,
-            'filename': filename,
-            'imgnum': imgnum,
+            'image': db_rec['image'],
+            'filename': db_rec['filename'] if 'filename' in db_rec else '',
+            'imgnum': db_rec['imgnum'] if 'imgnum' in db_rec else '',
             'joints': joints,
             'joints_vis': joints_vis,
             'center': c,
             'scale': s,
             'rotation': r,
-            'score': score
+            'score': db_rec['score'] if 'score' in db_rec else 1
         }
 
-        return input, target, target_weight, meta
+        return target, target_weight, meta
 
     def select_data(self, db):
         db_selected = []
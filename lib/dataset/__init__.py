@@ -9,7 +9,11 @@ from __future__ import division
 from __future__ import print_function
 
 from .mpii import MPIIDataset as mpii
+
+# DATASET.DATASET name -> dataset class
+DATASETS = {'mpii': mpii}
 try:
   from .coco import COCODataset as coco
+  DATASETS['coco'] = coco
 except:
-  print("Could not find coco.")
\ No newline at end of file
+  print("Could not find coco.")
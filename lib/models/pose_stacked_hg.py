@@ -1,7 +1,43 @@
+import contextlib
+
 import torch
 from torch import nn
+import torch.nn.functional as F
 from models import tdl
 
+
+def _layout_of(weight):
+  # Modules built to replace others take their weight's device and layout,
+  # so a channels_last model doesn't convert at every fused conv
+  if weight.is_contiguous(memory_format=torch.channels_last):
+    return {"device": weight.device, "memory_format": torch.channels_last}
+  return {"device": weight.device}
+
+
+def fuse_conv_bn(conv, bn):
+  """Fold an eval-mode BatchNorm into the preceding convolution."""
+  fused_conv = nn.Conv2d(
+      conv.in_channels,
+      conv.out_channels,
+      kernel_size=conv.kernel_size,
+      stride=conv.stride,
+      padding=conv.padding,
+      dilation=conv.dilation,
+      groups=conv.groups,
+      bias=True,
+  ).to(**_layout_of(conv.weight))
+  
+  with torch.no_grad():
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    if conv.bias is not None:
+      bias = conv.bias
+    else:
+      bias = torch.zeros_like(bn.running_mean)
+    fused_conv.weight.copy_(conv.weight * scale[:, None, None, None])
+    fused_conv.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+  
+  return fused_conv
+
   
 class IdentityMapping(nn.Module):
   def __init__(self, in_channels, out_channels, mode="per_channel"):
@@ -12,11 +48,20 @@ class IdentityMapping(nn.Module):
   
   def _setup_skip_conv(self, in_channels, out_channels):
     self._use_skip_conv = in_channels != out_channels
-    self.skip_conv = nn.Conv2d(
-      in_channels=in_channels,
-      out_channels=out_channels,
-      kernel_size=1
-    )
+    if self._use_skip_conv:
+      self.skip_conv = nn.Conv2d(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        kernel_size=1
+      )
+  
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Older checkpoints carry an unused skip_conv for in == out
+    if not self._use_skip_conv:
+      for key in [k for k in state_dict if k.startswith(prefix + "skip_conv.")]:
+        del state_dict[key]
+    super(IdentityMapping, self)._load_from_state_dict(
+        state_dict, prefix, *args, **kwargs)
       
   def _setup_alpha(self, out_channels):
     if self._mode == "per_channel":
@@ -52,6 +97,11 @@ class IdentityMapping(nn.Module):
 class MultiScaleResblock(nn.Module):
   def __init__(self, in_channels, out_channels, **kwargs):
     super(MultiScaleResblock, self).__init__()
+    # The three branches must tile the residual exactly; any leftover
+    # channels would be added in uninitialized
+    if in_channels % 4 != 0:
+      raise ValueError(
+          f"MultiScaleResblock needs in_channels divisible by 4, got {in_channels}")
     
     self.conv1 = nn.Conv2d(
         in_channels=in_channels, 
@@ -88,13 +138,30 @@ class MultiScaleResblock(nn.Module):
     self.bn1 = nn.BatchNorm2d(in_channels//2)
     self.bn2 = nn.BatchNorm2d(in_channels//4)
     self.bn3 = nn.BatchNorm2d(in_channels//4)
-    self.relu = nn.ReLU()
+    self.relu = nn.ReLU(inplace=True)
+    
+    # Channel slices of the residual written by each conv branch
+    c1 = in_channels//2
+    c2 = c1 + in_channels//4
+    self._slices = (slice(0, c1), slice(c1, c2), slice(c2, c2 + in_channels//4))
+    
+  def fuse(self):
+    self.conv1 = fuse_conv_bn(self.conv1, self.bn1)
+    self.conv2 = fuse_conv_bn(self.conv2, self.bn2)
+    self.conv3 = fuse_conv_bn(self.conv3, self.bn3)
+    self.bn1 = nn.Identity()
+    self.bn2 = nn.Identity()
+    self.bn3 = nn.Identity()
     
   def forward(self, x):
     out1 = self.relu(self.bn1(self.conv1(x)))
     out2 = self.relu(self.bn2(self.conv2(out1)))
     out3 = self.relu(self.bn3(self.conv3(out2)))
-    residual = torch.cat([out1, out2, out3], dim=1)
+    
+    # Write each branch into its slice rather than concatenating
+    residual = torch.empty_like(x, dtype=out1.dtype)
+    for channel_slice, out_i in zip(self._slices, (out1, out2, out3)):
+      residual[:, channel_slice].copy_(out_i)
     identity = self.identity_mapping(x)
       
     # Identity + Residual
@@ -118,7 +185,7 @@ class HeadLayer(nn.Module):
     )
     
     self.bn = nn.BatchNorm2d(hidden_channels)
-    self.relu = nn.ReLU()
+    self.relu = nn.ReLU(inplace=True)
     
     self.pool = nn.MaxPool2d((2,2))
     self.res_1 = MultiScaleResblock(
@@ -134,6 +201,10 @@ class HeadLayer(nn.Module):
         out_channels=in_channels, 
     )
   
+  def fuse(self):
+    self.conv = fuse_conv_bn(self.conv, self.bn)
+    self.bn = nn.Identity()
+  
   def forward(self, x):
     out = self.relu(self.bn(self.conv(x)))
     out = self.res_1(out)
@@ -147,8 +218,8 @@ class MergeDecoder(nn.Module):
   def __init__(self, mode, in_channels, out_channels, **kwargs):
     super(MergeDecoder, self).__init__()
     self._mode = mode
+    self._fused_up = False
     
-    self.up = nn.Upsample(scale_factor=2, mode="nearest")
     self.decode_conv = nn.Conv2d(
         in_channels,
         out_channels, 
@@ -157,10 +228,59 @@ class MergeDecoder(nn.Module):
         padding=1,
     )
     self.bn = nn.BatchNorm2d(out_channels)
-    self.relu = nn.ReLU()
+    self.relu = nn.ReLU(inplace=True)
+    
+  def fuse(self):
+    self.decode_conv = fuse_conv_bn(self.decode_conv, self.bn)
+    self.bn = nn.Identity()
+    self._fuse_upsample()
+    
+  def _fuse_upsample(self):
+    # conv3x3(up2(x)) == conv_transpose4x4_s2_p1(x) exactly, zero padding 
+    # included. Per axis, output pixel 2m sees x[m-1] through w[0] and x[m]
+    # through w[1] + w[2]; pixel 2m+1 sees x[m] through w[0] + w[1] and 
+    # x[m+1] through w[2]. In transposed-conv taps that is 
+    # W = [w2, w1 + w2, w0 + w1, w0] = M @ w, applied to both spatial axes.
+    # The conv is linear, so the down_feature branch keeps a plain conv3x3.
+    weight = self.decode_conv.weight
+    if self._mode == "concat":
+      n_up = weight.shape[1] // 2
+      up_weight, skip_weight = weight[:, :n_up], weight[:, n_up:]
+    else:
+      up_weight = skip_weight = weight
+    
+    M = weight.new_tensor([[0, 0, 1], [0, 1, 1], [1, 1, 0], [1, 0, 0]])
+    self.decode_convT = nn.ConvTranspose2d(
+        up_weight.shape[1],
+        up_weight.shape[0],
+        kernel_size=4,
+        stride=2,
+        padding=1,
+        bias=False,
+    ).to(**_layout_of(weight))
+    self.skip_conv = nn.Conv2d(
+        skip_weight.shape[1],
+        skip_weight.shape[0],
+        kernel_size=3,
+        stride=1,
+        padding=1,
+    ).to(**_layout_of(weight))
+    
+    with torch.no_grad():
+      self.decode_convT.weight.copy_(
+          torch.einsum("ka,oiab,lb->iokl", M, up_weight, M))
+      self.skip_conv.weight.copy_(skip_weight)
+      self.skip_conv.bias.copy_(self.decode_conv.bias)
+    
+    del self.decode_conv
+    self._fused_up = True
     
   def forward(self, x, down_feature):
-    residual = self.up(x)
+    if self._fused_up:
+      out = self.decode_convT(x) + self.skip_conv(down_feature)
+      return self.relu(self.bn(out))
+    
+    residual = F.interpolate(x, scale_factor=2, mode="nearest")
         
     if self._mode == "addition":
       out = residual + down_feature
@@ -179,15 +299,15 @@ class HourGlass(nn.Module):
       hidden_channels=None, 
       n_joints=16, 
       merge_mode="addition", 
+      strided_encoder=False,
       **kwargs
     ):
     super(HourGlass, self).__init__()
     self._stack_i = stack_i
     self._merge_mode = merge_mode
     
-    # Pooling and upsampling ops
+    # Pooling ops
     self.pool = nn.MaxPool2d((2,2))
-    self.up = nn.Upsample(scale_factor=2, mode="nearest")
     
     self.use_conversion_conv = False
     if hidden_channels and in_channels != hidden_channels:
@@ -206,45 +326,10 @@ class HourGlass(nn.Module):
       in_channels = hidden_channels
     
     # Encoder
-    self.encode_1 = nn.Sequential(
-        MultiScaleResblock(
-            in_channels=in_channels, 
-            out_channels=in_channels, 
-            **kwargs
-        ),
-        nn.MaxPool2d((2,2)),
-        nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1),
-    )
-    
-    self.encode_2 = nn.Sequential(
-        MultiScaleResblock(
-            in_channels=in_channels, 
-            out_channels=in_channels, 
-            **kwargs
-        ),
-        nn.MaxPool2d((2,2)),
-        nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1),
-    )
-    
-    self.encode_3 = nn.Sequential(
-        MultiScaleResblock(
-            in_channels=in_channels, 
-            out_channels=in_channels, 
-            **kwargs
-        ),
-        nn.MaxPool2d((2,2)),
-        nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1),
-    )
-    
-    self.encode_4 = nn.Sequential(
-        MultiScaleResblock(
-            in_channels=in_channels, 
-            out_channels=in_channels, 
-            **kwargs
-        ),
-        nn.MaxPool2d((2,2)),
-        nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1),
-    )
+    self.encoders = nn.ModuleList([
+        self._make_encoder(in_channels, strided_encoder, **kwargs)
+      for i in range(4)
+    ])
     
     # Decoder
     self.decode_1 = MergeDecoder(
@@ -274,22 +359,51 @@ class HourGlass(nn.Module):
         padding=1
     )
     
+  def _make_encoder(self, in_channels, strided, **kwargs):
+    resblock = MultiScaleResblock(
+        in_channels=in_channels, 
+        out_channels=in_channels, 
+        **kwargs
+    )
+    if strided:
+      # Approximates pool + conv with a single strided conv; not 
+      # interchangeable with checkpoints trained with the pooled encoder
+      return nn.Sequential(
+          resblock,
+          nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=2, padding=1),
+      )
+    return nn.Sequential(
+        resblock,
+        nn.MaxPool2d((2,2)),
+        nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1),
+    )
+  
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Older checkpoints name the encoders encode_1 ... encode_4
+    for encoder_i in range(len(self.encoders)):
+      old_prefix = f"{prefix}encode_{encoder_i + 1}."
+      new_prefix = f"{prefix}encoders.{encoder_i}."
+      for key in [k for k in state_dict if k.startswith(old_prefix)]:
+        state_dict[new_prefix + key[len(old_prefix):]] = state_dict.pop(key)
+    super(HourGlass, self)._load_from_state_dict(
+        state_dict, prefix, *args, **kwargs)
+    
   def forward(self, x):
     if self.use_conversion_conv:
       x = self.conversion_in_conv(x)
     
     # Encoder
-    down1 = self.encode_1(x)
-    down2 = self.encode_2(down1)
-    down3 = self.encode_3(down2)
-    down4 = self.encode_4(down3)
+    downs = []
+    for encoder in self.encoders:
+      x = encoder(x)
+      downs.append(x)
     
     # Decoder
-    up1 = self.decode_1(down4, down3)
-    up2 = self.decode_2(up1, down2)
-    up3 = self.decode_3(up2, down1)
+    up1 = self.decode_1(downs[-1], downs[-2])
+    up2 = self.decode_2(up1, downs[-3])
+    up3 = self.decode_3(up2, downs[-4])
     
-    up4 = self.up(up3)
+    up4 = F.interpolate(up3, scale_factor=2, mode="nearest")
     out = self.final_up(up4)
     
     if self.use_conversion_conv:
@@ -306,6 +420,7 @@ class PoseNet(nn.Module):
                n_features=128, 
                n_joints=16, 
                merge_mode="concat", 
+               enable_amp=False,
                **kwargs):
     super(PoseNet, self).__init__()
     self._n_stacks = n_stacks
@@ -313,8 +428,8 @@ class PoseNet(nn.Module):
     self._n_double_features = n_double_features
     self._double_stack = double_stack
     self._merge_mode = merge_mode
+    self._enable_amp = enable_amp
     self._kwargs = kwargs
-    self.relu = nn.ReLU()
     
     # Head layer
     self.head_layer = HeadLayer(in_channels=n_features, hidden_channels=64)
@@ -333,7 +448,7 @@ class PoseNet(nn.Module):
           ),
           nn.Conv2d(n_features, n_features, kernel_size=1, stride=1),
           nn.BatchNorm2d(n_features),
-          self.relu,
+          nn.ReLU(inplace=True),
         )
       for i in range(self._n_stacks)
     ])
@@ -348,38 +463,36 @@ class PoseNet(nn.Module):
     self.remaps = nn.ModuleList([
         nn.Sequential(
           nn.Conv2d(n_joints, n_features, kernel_size=1, stride=1),
-          self.relu,
+          nn.ReLU(inplace=True),
         )
       for i in range(self._n_stacks)
     ])
     
   def _setup_hgs(self):
     if self._kwargs.get("share_weights", False):
+      # Register each distinct hourglass once; stack_i uses 
+      # self.hgs[stack_i // self._stacks_per_hg]
+      self._stacks_per_hg = self._n_stacks
+      hg_models = [
+          HourGlass(
+              stack_i=0, 
+              in_channels=self._n_features, 
+              merge_mode=self._merge_mode, 
+              **self._kwargs
+          )
+      ]
       if self._double_stack:
-        small_hg_model = HourGlass(
-            stack_i=0, 
-            in_channels=self._n_features, 
-            merge_mode=self._merge_mode, 
-            **self._kwargs
-        )
-        first_stack = [small_hg_model for i in range(self._n_stacks)]
-        large_hg_model = HourGlass(
-            stack_i=1, 
-            in_channels=self._n_double_features, 
-            merge_mode=self._merge_mode, 
-            **self._kwargs
-        )
-        second_stack = [large_hg_model for i in range(self._n_stacks)]
-        self.hgs = nn.ModuleList(first_stack + second_stack)
-      else:
-        hg_model = HourGlass(
-            stack_i=0, 
-            in_channels=self._n_features, 
-            merge_mode=self._merge_mode, 
-            **self._kwargs
+        hg_models.append(
+            HourGlass(
+                stack_i=1, 
+                in_channels=self._n_double_features, 
+                merge_mode=self._merge_mode, 
+                **self._kwargs
+            )
         )
-        self.hgs = nn.ModuleList([hg_model for i in range(self._n_stacks)])
+      self.hgs = nn.ModuleList(hg_models)
     else:
+      self._stacks_per_hg = 1
       if self._double_stack:
         first_stack = [
             HourGlass(
@@ -416,20 +529,71 @@ class PoseNet(nn.Module):
           for i in range(self._n_stacks)
         ])
   
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Older shared-weight checkpoints stored the hourglass once per stack
+    hg_prefix = prefix + "hgs."
+    hg_keys = [k for k in state_dict if k.startswith(hg_prefix)]
+    hg_ids = [int(k[len(hg_prefix):].split(".")[0]) for k in hg_keys]
+    if self._stacks_per_hg > 1 and hg_ids and max(hg_ids) >= len(self.hgs):
+      remapped = {}
+      for key, hg_i in zip(hg_keys, hg_ids):
+        value = state_dict.pop(key)
+        if hg_i % self._stacks_per_hg == 0:
+          rest = key[len(hg_prefix):].split(".", 1)[1]
+          remapped[f"{hg_prefix}{hg_i // self._stacks_per_hg}.{rest}"] = value
+      state_dict.update(remapped)
+    super(PoseNet, self)._load_from_state_dict(
+        state_dict, prefix, *args, **kwargs)
+  
+  def fuse(self):
+    """Fold BatchNorms into their convs for inference; call after loading weights."""
+    if self.training:
+      raise RuntimeError("fuse() requires the model to be in eval mode")
+    
+    fusable = (MultiScaleResblock, HeadLayer, MergeDecoder)
+    for module in [m for m in self.modules() if isinstance(m, fusable)]:
+      module.fuse()
+    
+    for feature_map in self.feature_maps:
+      feature_map[1] = fuse_conv_bn(feature_map[1], feature_map[2])
+      feature_map[2] = nn.Identity()
+    
+    return self
+  
   def forward(self, x):
-    x = self.head_layer(x)
-    logits = []
-    for stack_i in range(self._n_stacks):
-      identity = x.clone()
-      hg_out = self.hgs[stack_i](x)
-      features_i = self.feature_maps[stack_i](hg_out)
-      logit_i = self.logit_maps[stack_i](features_i)
-      logits.append(logit_i)
-      residual = features_i + self.remaps[stack_i](logit_i)
-      
-      x = identity + residual
+    x = x.contiguous(memory_format=torch.channels_last)
+    # Taken before autocast, so logits keep the model's own dtype
+    out_dtype = x.dtype
+    
+    # A disabled autocast block would switch off a caller's autocast too,
+    # so only enter one when enabled
+    if self._enable_amp:
+      amp_context = torch.autocast(device_type=x.device.type, dtype=torch.bfloat16)
+    else:
+      amp_context = contextlib.nullcontext()
+    with amp_context:
+      x = self.head_layer(x)
+      for stack_i in range(self._n_stacks):
+        hg_out = self.hgs[stack_i // self._stacks_per_hg](x)
+        features_i = self.feature_maps[stack_i](hg_out)
+        logit_i = self.logit_maps[stack_i](features_i)
+        
+        # Write each stack's logits straight into the stacked output.
+        # Kept in the input dtype rather than autocast's, since downstream
+        # metrics go through numpy, which has no bfloat16
+        if stack_i == 0:
+          logits = logit_i.new_empty(
+              (self._n_stacks, *logit_i.shape), dtype=out_dtype)
+        logits[stack_i].copy_(logit_i)
+        
+        # Nothing reads x after the last stack, so its remap is skipped;
+        # that remap's parameters never get a gradient (see train.py's DDP)
+        if stack_i + 1 < self._n_stacks:
+          residual = features_i + self.remaps[stack_i](logit_i)
+          
+          # The hourglass never writes into x, so no copy is needed
+          x = x + residual
     
-    logits = torch.stack(logits)
     return logits
   
 
@@ -439,6 +603,10 @@ def get_pose_net(cfg, is_train, **kwargs):
     share_weights = cfg.MODEL.EXTRA.SHARE_HG_WEIGHTS
   else:
     share_weights = False
+  if "STRIDED_ENCODER" in cfg.MODEL.EXTRA:
+    strided_encoder = cfg.MODEL.EXTRA.STRIDED_ENCODER
+  else:
+    strided_encoder = False
   model = PoseNet(
       n_stacks=n_hg_stacks,
       double_stack=cfg.MODEL.EXTRA.DOUBLE_STACK,
@@ -446,8 +614,15 @@ def get_pose_net(cfg, is_train, **kwargs):
       n_features=cfg.MODEL.NUM_CHANNELS,
       n_joints=cfg.MODEL.NUM_JOINTS,
       merge_mode=cfg.MODEL.MERGE_MODE,
+      enable_amp=cfg.MODEL.ENABLE_AMP,
       identity_gating_mode="per_channel",
       share_weights=share_weights,
+      strided_encoder=strided_encoder,
   )
+  model = model.to(memory_format=torch.channels_last)
+  
+  # Compile in place so state_dict keys match uncompiled checkpoints
+  if cfg.MODEL.COMPILE and hasattr(model, "compile"):
+    model.compile(mode="reduce-overhead", fullgraph=False, dynamic=False)
 
   return model
\ No newline at end of file
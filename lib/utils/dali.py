@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+
+class _PoseSampleSource(object):
+    """Per-sample external source: shards and shuffles the dataset like
+    DistributedSampler with drop_last, and hands DALI each sample's encoded
+    image and crop matrix from JointsDataset.get_encoded().
+    """
+    def __init__(self, dataset, batch_size, shard_id, num_shards, shuffle):
+        self.dataset = dataset
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        per_shard = len(dataset) // num_shards
+        self.samples_per_shard = per_shard - per_shard % batch_size
+        self._epoch = None
+        self._order = None
+
+    def __call__(self, sample_info):
+        if sample_info.idx_in_epoch >= self.samples_per_shard:
+            raise StopIteration
+
+        if sample_info.epoch_idx != self._epoch:
+            # Seeded by epoch alone so every rank draws the same order
+            self._epoch = sample_info.epoch_idx
+            if self.shuffle:
+                rng = np.random.RandomState(self._epoch)
+                self._order = rng.permutation(len(self.dataset))
+            else:
+                self._order = np.arange(len(self.dataset))
+
+        idx = self._order[self.shard_id + sample_info.idx_in_epoch * self.num_shards]
+        encoded, trans, target, target_weight, joints, joints_vis = \
+            self.dataset.get_encoded(idx)
+
+        # cv2 puts pixel centers on integer coordinates, DALI on half
+        # integers; conjugate the matrix so both warps sample alike
+        trans = trans.copy()
+        trans[:, 2] += 0.5 - trans[:, :2].sum(axis=1) * 0.5
+
+        return encoded, trans, target, target_weight, joints, joints_vis
+
+
+class DALIPoseLoader(object):
+    """Training loader that decodes JPEGs with nvJPEG and warps and
+    normalizes the crops on the GPU with NVIDIA DALI.
+
+    Yields the same (input, target, target_weight, meta) batches as
+    PrefetchLoader, with input as float channels_last on the current GPU.
+    meta only carries the joints and joints_vis used by the debug images.
+    Augmentation parameters and heatmaps are still drawn on the CPU by the
+    dataset, in py_num_workers worker processes as a DataLoader would.
+    """
+    def __init__(self, dataset, batch_size, mean, std, num_threads=4,
+                 py_num_workers=4, shard_id=0, num_shards=1, shuffle=True):
+        from nvidia.dali import fn
+        from nvidia.dali import pipeline_def
+        from nvidia.dali import types
+        from nvidia.dali.plugin.pytorch import DALIGenericIterator
+        from nvidia.dali.plugin.pytorch import LastBatchPolicy
+
+        self.dataset = dataset
+        source = _PoseSampleSource(
+            dataset, batch_size, shard_id, num_shards, shuffle)
+        self._len = source.samples_per_shard // batch_size
+        # (H, W), as DALI orders spatial sizes
+        crop_size = (int(dataset.image_size[1]), int(dataset.image_size[0]))
+
+        # The source runs in its own processes; spawned, since CUDA is
+        # already initialized in this one
+        @pipeline_def(batch_size=batch_size, num_threads=num_threads,
+                      device_id=torch.cuda.current_device(),
+                      py_num_workers=py_num_workers,
+                      py_start_method='spawn')
+        def pose_pipeline():
+            encoded, trans, target, target_weight, joints, joints_vis = \
+                fn.external_source(source=source, num_outputs=6, batch=False,
+                                   parallel=True)
+            # BGR and EXIF orientation ignored, as cv2.imread gives the CPU
+            # path; the matrix and flip width are for the unrotated image
+            images = fn.decoders.image(
+                encoded, device='mixed', output_type=types.BGR,
+                adjust_orientation=False)
+            images = fn.warp_affine(
+                images, trans.gpu(), size=crop_size, inverse_map=False,
+                interp_type=types.INTERP_LINEAR, fill_value=0)
+            # mean/std are given for [0, 1] images. Kept HWC so the batch
+            # is already channels_last once viewed as NCHW
+            images = fn.crop_mirror_normalize(
+                images, dtype=types.FLOAT, output_layout='HWC',
+                mean=[m * 255 for m in mean], std=[s * 255 for s in std])
+            return (images, target.gpu(), target_weight.gpu(),
+                    joints, joints_vis)
+
+        pipe = pose_pipeline()
+        pipe.build()
+        self._iterator = DALIGenericIterator(
+            pipe,
+            ['input', 'target', 'target_weight', 'joints', 'joints_vis'],
+            last_batch_policy=LastBatchPolicy.DROP,
+            auto_reset=True,
+        )
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for batch in self._iterator:
+            batch = batch[0]
+            meta = {
+                'joints': batch['joints'],
+                'joints_vis': batch['joints_vis'],
+            }
+            yield (batch['input'].permute(0, 3, 1, 2),
+                   batch['target'],
+                   batch['target_weight'],
+                   meta)
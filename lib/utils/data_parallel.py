@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+
+
+class DataParallelCachedModel(torch.nn.DataParallel):
+    """DataParallel that keeps its per-GPU replicas between forward calls.
+
+    Stock DataParallel broadcasts every parameter and buffer to each GPU on
+    every forward. Here the replicas are built once and reused until
+    update_replicates() is called, which must happen after every
+    optimizer.step() so the replicas see the new weights. Replicas are also
+    rebuilt when train()/eval() or the grad mode changes, since a replica
+    made under no_grad is detached from the parameters.
+    """
+    def __init__(self, module, device_ids=None, output_device=None, dim=0):
+        super(DataParallelCachedModel, self).__init__(
+            module, device_ids, output_device, dim)
+        self._replicas = None
+        self._replicas_key = None
+
+    def update_replicates(self):
+        # Dropped rather than rebuilt so the next forward replicates under
+        # its own grad mode
+        self._replicas = None
+
+    def train(self, mode=True):
+        self.update_replicates()
+        return super(DataParallelCachedModel, self).train(mode)
+
+    def forward(self, *inputs, **kwargs):
+        if not self.device_ids:
+            return self.module(*inputs, **kwargs)
+
+        inputs, kwargs = self.scatter(inputs, kwargs, self.device_ids)
+        if len(self.device_ids) == 1:
+            return self.module(*inputs[0], **kwargs[0])
+
+        key = (self.training, torch.is_grad_enabled())
+        if self._replicas is None or self._replicas_key != key:
+            self._replicas = self.replicate(self.module, self.device_ids)
+            self._replicas_key = key
+
+        outputs = self.parallel_apply(
+            self._replicas[:len(inputs)], inputs, kwargs)
+        return self.gather(outputs, self.output_device)
@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def fast_collate(batch):
+    """Collates samples whose image is the raw HWC uint8 crop, i.e. a
+    dataset built without a transform.
+
+    Images are batched as uint8 into NHWC storage and returned as an NCHW
+    channels_last view, so there is no per-sample float conversion or
+    transpose on the CPU. The remaining fields use the default collate.
+    """
+    height, width, channels = batch[0][0].shape
+    images = torch.empty((len(batch), height, width, channels),
+                         dtype=torch.uint8)
+    for i, sample in enumerate(batch):
+        images[i].copy_(torch.from_numpy(sample[0]))
+
+    rest = default_collate([sample[1:] for sample in batch])
+    return (images.permute(0, 3, 1, 2),) + tuple(rest)
+
+
+class PrefetchLoader(object):
+    """Wraps a DataLoader so that the next batch is copied to the GPU and
+    normalized on a side stream while the current batch is being consumed.
+
+    The wrapped loader must yield unnormalized uint8 images in [0, 255], as
+    fast_collate() does. Images come out as float channels_last to match
+    the layout get_pose_net() puts the model in.
+    """
+    def __init__(self, loader, mean, std):
+        self.loader = loader
+        # mean/std are given for [0, 1] images; fold the 255 scale in
+        self.mean = torch.tensor(mean).cuda().view(1, 3, 1, 1) * 255
+        self.std_inv = 1.0 / (torch.tensor(std).cuda().view(1, 3, 1, 1) * 255)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        first = True
+
+        for next_x, next_target, next_weight, next_meta in self.loader:
+            with torch.cuda.stream(stream):
+                next_x = next_x.cuda(non_blocking=True).float()
+                next_x = next_x.sub_(self.mean).mul_(self.std_inv)
+                # Hand the model NHWC input so it doesn't convert per step
+                next_x = next_x.contiguous(memory_format=torch.channels_last)
+                next_target = next_target.cuda(non_blocking=True)
+                next_weight = next_weight.cuda(non_blocking=True)
+
+            if not first:
+                yield x_data, target, target_weight, meta
+            else:
+                first = False
+
+            torch.cuda.current_stream().wait_stream(stream)
+            # Tensors allocated on the side stream are now used on this one
+            for t in (next_x, next_target, next_weight):
+                t.record_stream(torch.cuda.current_stream())
+            x_data = next_x
+            target = next_target
+            target_weight = next_weight
+            meta = next_meta
+
+        if not first:
+            yield x_data, target, target_weight, meta
@@ -8,30 +8,45 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import os
 import logging
+import shutil
 import time
+from functools import lru_cache
 from pathlib import Path
 
-import torch
-import torch.optim as optim
-
 from core.config import get_model_name
 
 
-def get_dataset_name(cfg):
-    dataset = cfg.DATASET.DATASET + '_' + cfg.DATASET.HYBRID_JOINTS_TYPE \
-        if cfg.DATASET.HYBRID_JOINTS_TYPE else cfg.DATASET.DATASET
+@lru_cache(maxsize=None)
+def _dataset_name_cached(dataset, hybrid_joints_type):
+    dataset = dataset + '_' + hybrid_joints_type \
+        if hybrid_joints_type else dataset
     dataset = dataset.replace(':', '_')
     return dataset
 
-def create_experiment_directory(cfg, cfg_name, distillation=False, make_dir=True):
-    root_output_dir = Path(cfg.OUTPUT_DIR)
-    # set up logger
-    if not root_output_dir.exists() and make_dir:
-        print('=> creating {}'.format(root_output_dir))
-        root_output_dir.mkdir()
 
+def get_dataset_name(cfg):
+    return _dataset_name_cached(cfg.DATASET.DATASET,
+                                cfg.DATASET.HYBRID_JOINTS_TYPE)
+
+
+@lru_cache(maxsize=None)
+def _derive_dir(root_dir, *parts):
+    return Path(root_dir).joinpath(*parts)
+
+
+@lru_cache(maxsize=None)
+def _make_dir(path):
+    # Cached so repeated requests for the same directory skip the filesystem
+    try:
+        path.mkdir(parents=True)
+    except FileExistsError:
+        pass
+
+
+def create_experiment_directory(cfg, cfg_name, distillation=False, make_dir=True):
     dataset = get_dataset_name(cfg)
     model, _ = get_model_name(cfg)
     small = "small" in cfg_name
@@ -54,10 +69,11 @@ def create_experiment_directory(cfg, cfg_name, distillation=False, make_dir=True
     if cfg.MODEL.EXTRA.DOUBLE_STACK:
         model_str = model_str + "__double"
 
-    final_output_dir = root_output_dir / dataset / model_str
+    final_output_dir = _derive_dir(cfg.OUTPUT_DIR, dataset, model_str)
     if make_dir:
+        # parents=True also creates cfg.OUTPUT_DIR
         print('=> creating {}'.format(final_output_dir))
-        final_output_dir.mkdir(parents=True, exist_ok=True)
+        _make_dir(final_output_dir)
 
     return str(final_output_dir)
 
@@ -76,16 +92,21 @@ def create_logger(cfg, cfg_name, final_output_dir, phase='train', make_dir=True)
     console = logging.StreamHandler()
     logging.getLogger('').addHandler(console)
 
-    tensorboard_log_dir = Path(cfg.LOG_DIR) / dataset / model / \
-        (cfg_name + '_' + time_str)
+    tensorboard_log_dir = _derive_dir(cfg.LOG_DIR, dataset, model,
+                                      cfg_name + '_' + time_str)
     print('=> creating {}'.format(tensorboard_log_dir))
     if make_dir:
-        tensorboard_log_dir.mkdir(parents=True, exist_ok=True)
+        _make_dir(tensorboard_log_dir)
 
     return logger, str(tensorboard_log_dir)
 
 
 def get_optimizer(cfg, model):
+    import torch.optim as optim
+
+    # Steps replayed from a CUDA graph need their state kept on the GPU
+    graph_kwargs = {'capturable': True} if cfg.TRAIN.CUDA_GRAPH else {}
+
     optimizer = None
     if cfg.TRAIN.OPTIMIZER == 'sgd':
         optimizer = optim.SGD(
@@ -93,29 +114,92 @@ def get_optimizer(cfg, model):
             lr=cfg.TRAIN.LR,
             momentum=cfg.TRAIN.MOMENTUM,
             weight_decay=cfg.TRAIN.WD,
-            nesterov=cfg.TRAIN.NESTEROV
+            nesterov=cfg.TRAIN.NESTEROV,
+            # The HG has many small conv tensors; update them all in one
+            # multi-tensor kernel instead of one launch per parameter
+            foreach=True
         )
     elif cfg.TRAIN.OPTIMIZER == 'adam':
         optimizer = optim.Adam(
             model.parameters(),
             lr=cfg.TRAIN.LR,
             weight_decay=cfg.TRAIN.WD,
+            # One fused kernel for the whole update
+            fused=True,
+            **graph_kwargs
         )
     elif cfg.TRAIN.OPTIMIZER == 'rmsprop':
         optimizer = optim.RMSprop(
             model.parameters(),
             lr=cfg.TRAIN.LR,
             weight_decay=cfg.TRAIN.WD,
+            # Multi-tensor kernel, as for SGD
+            foreach=True,
+            **graph_kwargs
         )
 
     return optimizer
 
 
+def cpu_snapshot(state):
+    # Copies every tensor in a (nested) state dict to host memory, so the
+    # snapshot can be saved while training keeps updating the originals
+    if hasattr(state, 'detach'):
+        state = state.detach()
+        return state.cpu() if state.is_cuda else state.clone()
+    if isinstance(state, dict):
+        return {k: cpu_snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(v) for v in state)
+    return state
+
+
 def save_checkpoint(save_dict, is_best, output_dir, filename='checkpoint.pth.tar'):
-    # Checkpoint
+    import torch
+
+    # Checkpoint; written to a temp file first so readers never see a
+    # partial checkpoint
     ckpt_path = os.path.join(output_dir, filename)
-    torch.save(save_dict, ckpt_path)
-    
+    tmp_path = ckpt_path + '.tmp'
+    torch.save(save_dict, tmp_path)
+    os.replace(tmp_path, ckpt_path)
+
+    # Reuse the bytes just written rather than serializing twice. The
+    # checkpoint is always replaced, never rewritten, so a hard link is safe
     best_ckpt_path = os.path.join(output_dir, 'model_best.pth.tar')
     if is_best:
-        torch.save(save_dict, best_ckpt_path)
+        tmp_best_path = best_ckpt_path + '.tmp'
+        try:
+            os.link(ckpt_path, tmp_best_path)
+        except OSError:
+            shutil.copyfile(ckpt_path, tmp_best_path)
+        os.replace(tmp_best_path, best_ckpt_path)
+
+
+def snapshot_source(src_path, output_dir):
+    # Keeps one copy per distinct content, named by its hash, and points
+    # <output_dir>/<name> at it, so re-running with unchanged source only
+    # swaps a link. A plain symlink to src_path wouldn't survive later
+    # edits to the source
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    name = os.path.basename(src_path)
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    blob_path = os.path.join(output_dir, '{}.{}{}'.format(stem, digest, ext))
+    if not os.path.exists(blob_path):
+        with open(blob_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(blob_path + '.tmp', blob_path)
+
+    dst_path = os.path.join(output_dir, name)
+    tmp_path = dst_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        # Relative, so the output directory can be moved
+        os.symlink(os.path.basename(blob_path), tmp_path)
+    except (OSError, NotImplementedError):
+        # e.g. Windows without symlink privileges
+        shutil.copyfile(blob_path, tmp_path)
+    os.replace(tmp_path, dst_path)
@@ -11,7 +11,6 @@ from __future__ import print_function
 import argparse
 import os
 import pprint
-import shutil
 
 import torch
 import torch.nn.parallel
@@ -31,6 +30,8 @@ from core.distillation_function import train, validate
 from utils.utils import get_optimizer
 from utils.utils import save_checkpoint
 from utils.utils import create_experiment_directory
+from utils.utils import snapshot_source
+from utils.data_parallel import DataParallelCachedModel
 
 import dataset
 import models.pose_stacked_hg
@@ -117,7 +118,7 @@ def setup_teacher(config, args, gpus):
     # Set cfg back to original
     args.cfg = original_cfg
     update_config(args.cfg)
-    teacher_model = torch.nn.DataParallel(teacher_model, device_ids=gpus).cuda()
+    teacher_model = DataParallelCachedModel(teacher_model, device_ids=gpus).cuda()
     return teacher_model
 
   
@@ -137,14 +138,19 @@ def main():
     cudnn.benchmark = config.CUDNN.BENCHMARK
     torch.backends.cudnn.deterministic = config.CUDNN.DETERMINISTIC
     torch.backends.cudnn.enabled = config.CUDNN.ENABLED
+    # TF32 tensor cores on Ampere+ for convs and matmuls, unless runs
+    # must be bitwise reproducible
+    allow_tf32 = not config.CUDNN.DETERMINISTIC
+    torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+    torch.backends.cudnn.allow_tf32 = allow_tf32
 
     # Setup model
     model = models.pose_stacked_hg.get_pose_net(config, is_train=True)
     
-    # copy model file
+    # snapshot model file
     print("Copying model file...")
     this_dir = os.path.dirname(__file__)
-    shutil.copy2(
+    snapshot_source(
         os.path.join(this_dir, '../lib/models', config.MODEL.NAME + '.py'),
         output_dir
     )
@@ -158,7 +164,7 @@ def main():
     print("Parallelizing model...")
     gpus = [int(i) for i in config.GPUS.split(',')]
     print(f"GPUS: {gpus}")
-    model = torch.nn.DataParallel(model, device_ids=gpus).cuda()
+    model = DataParallelCachedModel(model, device_ids=gpus).cuda()
     
     # Setup teacher
     teacher_model = setup_teacher(config, args, gpus)
@@ -184,25 +190,24 @@ def main():
         mean=[0.485, 0.456, 0.406],
         std=[0.229, 0.224, 0.225]
     )
-    train_dataset = eval('dataset.'+config.DATASET.DATASET)(
+    dataset_cls = dataset.DATASETS[config.DATASET.DATASET]
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        normalize,
+    ])
+    train_dataset = dataset_cls(
         config,
         config.DATASET.ROOT,
         config.DATASET.TRAIN_SET,
         True,
-        transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-        ])
+        transform
     )
-    valid_dataset = eval('dataset.'+config.DATASET.DATASET)(
+    valid_dataset = dataset_cls(
         config,
         config.DATASET.ROOT,
         config.DATASET.TEST_SET,
         False,
-        transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-        ])
+        transform
     )
 
     print("Setting up dataset loaders...")
@@ -221,6 +226,17 @@ def main():
         pin_memory=True
     )
 
+    model_name = get_model_name(config)
+
+    def make_save_dict(epoch_i, perf):
+        return {
+            'epoch_i': epoch_i + 1,
+            'model': model_name,
+            'state_dict': model.module.state_dict(),
+            'perf': perf,
+            'optimizer': optimizer.state_dict(),
+        }
+
     print("Training model...")
     best_perf = 0.0
     best_model = False
@@ -256,25 +272,12 @@ def main():
         else:
             best_model = False
 
-        save_dict = {
-            'epoch_i': epoch_i + 1,
-            'model': get_model_name(config),
-            'state_dict': model.module.state_dict(),
-            'perf': perf_indicator,
-            'optimizer': optimizer.state_dict(),
-        }
-        save_checkpoint(save_dict, best_model, output_dir)
+        save_checkpoint(
+            make_save_dict(epoch_i, perf_indicator), best_model, output_dir)
 
     # Final ckpt save
-    save_dict = {
-        'epoch_i': epoch_i + 1,
-        'model': get_model_name(config),
-        'state_dict': model.module.state_dict(),
-        'perf': perf_indicator,
-        'optimizer': optimizer.state_dict(),
-    }
     save_checkpoint(
-        save_dict, 
+        make_save_dict(epoch_i, perf_indicator),
         False, 
         output_dir, 
         filename='final_state.pth.tar'
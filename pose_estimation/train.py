@@ -9,17 +9,18 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
 import os
 import pprint
-import shutil
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.transforms as transforms
 
 import _init_paths
 from core.config import config
@@ -29,13 +30,24 @@ from core.config import get_model_name
 from core.loss import TDLambda_JointsMSELoss
 from core.function import train
 from core.function import validate
+from core.function import get_amp_dtype
+from core.function import GraphedTrainStep
 from utils.utils import get_optimizer
 from utils.utils import save_checkpoint
+from utils.utils import cpu_snapshot
 from utils.utils import create_experiment_directory
+from utils.utils import snapshot_source
+from utils.prefetch import PrefetchLoader
+from utils.prefetch import fast_collate
+from utils.dali import DALIPoseLoader
 import dataset
 import models.pose_stacked_hg
 
 
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Train keypoints network')
     # general
@@ -72,10 +84,16 @@ def reset_config(config, args):
         config.WORKERS = args.workers
 
 
-def main():
-    args = parse_args()
+def main_worker(rank, gpus, args):
+    # Spawned workers start from a fresh interpreter, so reload the config
+    update_config(args.cfg)
     reset_config(config, args)
 
+    world_size = len(gpus)
+    device = gpus[rank]
+    torch.cuda.set_device(device)
+    dist.init_process_group(backend='nccl', rank=rank, world_size=world_size)
+
     print("Setting up output experimental directory")
     output_dir = create_experiment_directory(
         config, 
@@ -87,28 +105,55 @@ def main():
     cudnn.benchmark = config.CUDNN.BENCHMARK
     torch.backends.cudnn.deterministic = config.CUDNN.DETERMINISTIC
     torch.backends.cudnn.enabled = config.CUDNN.ENABLED
+    # TF32 tensor cores on Ampere+ for convs and matmuls, unless runs
+    # must be bitwise reproducible
+    allow_tf32 = not config.CUDNN.DETERMINISTIC
+    torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+    torch.backends.cudnn.allow_tf32 = allow_tf32
 
     # Setup model
     model = models.pose_stacked_hg.get_pose_net(config, is_train=True)
 
-    # copy model file
-    print("Copying model file...")
-    this_dir = os.path.dirname(__file__)
-    shutil.copy2(
-        os.path.join(this_dir, '../lib/models', config.MODEL.NAME + '.py'),
-        output_dir
-    )
+    # snapshot model file; every rank shares output_dir, so only once
+    if rank == 0:
+        print("Copying model file...")
+        this_dir = os.path.dirname(__file__)
+        snapshot_source(
+            os.path.join(this_dir, '../lib/models', config.MODEL.NAME + '.py'),
+            output_dir
+        )
 
     dump_input = torch.rand((config.TRAIN.BATCH_SIZE,
                             3,
                             config.MODEL.IMAGE_SIZE[1],
                             config.MODEL.IMAGE_SIZE[0]))
 
-    # Setup parallel model
-    print("Parallelizing model...")
-    gpus = [int(i) for i in config.GPUS.split(',')]
-    print(f"GPUS: {gpus}")
-    model = torch.nn.DataParallel(model, device_ids=gpus).cuda()
+    # Setup distributed model
+    print(f"Distributing model: rank {rank}/{world_size}, GPU {device}")
+    model = model.cuda(device)
+    accum_steps = config.TRAIN.ACCUM_STEPS
+    model = torch.nn.parallel.DistributedDataParallel(
+        model, 
+        device_ids=[device],
+        # Fewer, larger allreduce buckets, with grads living in the buckets
+        # so there's no copy in or out; the graph is the same every step
+        bucket_cap_mb=50,
+        gradient_as_bucket_view=True,
+        # Required, not tuning: the last stack's remap never gets a
+        # gradient, and plain DDP fails on the second iteration waiting
+        # for it. static_graph records that once; it needs its first
+        # iteration synced though, and with accumulation that one runs
+        # under no_sync(), so search for unused parameters instead
+        static_graph=accum_steps == 1,
+        find_unused_parameters=accum_steps > 1,
+    )
+    if config.TRAIN.COMPILE:
+        # MODEL.COMPILE would compile the wrapped module a second time
+        if config.MODEL.COMPILE:
+            raise ValueError("TRAIN.COMPILE and MODEL.COMPILE are exclusive")
+        # Compiled in place so .module and no_sync() stay reachable; Inductor
+        # splits the graph at the DDP buckets to keep allreduce overlapped
+        model.compile(mode="max-autotune", fullgraph=False, dynamic=False)
 
     print("Setting up criterion, optimizer, and LR scheduling...")
     # define loss function (criterion) and optimizer
@@ -117,6 +162,8 @@ def main():
         lambda_val=config.LOSS.TD_LAMBDA, 
         normalize_loss=config.LOSS.NORMALIZE
     ).cuda()
+    if config.TRAIN.COMPILE:
+        criterion.compile(dynamic=False)
 
     optimizer = get_optimizer(config, model)
 
@@ -125,52 +172,123 @@ def main():
     )
 
     print("Setting up datasets...")
-    # Data loading code
-    normalize = transforms.Normalize(
-        mean=[0.485, 0.456, 0.406],
-        std=[0.229, 0.224, 0.225]
-    )
-    train_dataset = eval('dataset.'+config.DATASET.DATASET)(
+    # Data loading code; samples stay uint8 and fast_collate batches them
+    # as is, so float conversion and normalization happen on the GPU in
+    # PrefetchLoader
+    dataset_cls = dataset.DATASETS[config.DATASET.DATASET]
+    transform = None
+    train_dataset = dataset_cls(
         config,
         config.DATASET.ROOT,
         config.DATASET.TRAIN_SET,
         True,
-        transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-        ])
+        transform
     )
-    valid_dataset = eval('dataset.'+config.DATASET.DATASET)(
+    valid_dataset = dataset_cls(
         config,
         config.DATASET.ROOT,
         config.DATASET.TEST_SET,
         False,
-        transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-        ])
+        transform
     )
 
     print("Setting up dataset loaders...")
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_size=config.TRAIN.BATCH_SIZE*len(gpus),
-        shuffle=config.TRAIN.SHUFFLE,
-        num_workers=config.WORKERS,
-        pin_memory=True
-    )
+    # Every process spawns its own workers; don't oversubscribe the host
+    num_workers = min(config.WORKERS, max(1, os.cpu_count() // world_size))
+    # Keep workers alive across epochs and queue deeper; both options
+    # are only accepted with worker processes
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4}
+    # Each process loads its own shard at the per-GPU batch size
+    train_sampler = None
+    if config.DATASET.USE_DALI:
+        # DALI shards and reshuffles by itself every epoch
+        train_loader = DALIPoseLoader(
+            train_dataset,
+            config.TRAIN.BATCH_SIZE,
+            IMAGE_MEAN,
+            IMAGE_STD,
+            # DALI needs at least one thread and one source worker
+            num_threads=max(1, num_workers),
+            py_num_workers=max(1, num_workers),
+            shard_id=rank,
+            num_shards=world_size,
+            shuffle=config.TRAIN.SHUFFLE,
+        )
+    else:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            train_dataset,
+            num_replicas=world_size,
+            rank=rank,
+            shuffle=config.TRAIN.SHUFFLE,
+        )
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=config.TRAIN.BATCH_SIZE,
+            shuffle=False,
+            sampler=train_sampler,
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=True,
+            collate_fn=fast_collate,
+            **worker_kwargs
+        )
+        train_loader = PrefetchLoader(train_loader, IMAGE_MEAN, IMAGE_STD)
     valid_loader = torch.utils.data.DataLoader(
         valid_dataset,
-        batch_size=config.TEST.BATCH_SIZE*len(gpus),
+        batch_size=config.TEST.BATCH_SIZE,
         shuffle=False,
-        num_workers=config.WORKERS,
-        pin_memory=True
+        num_workers=num_workers,
+        pin_memory=True,
+        collate_fn=fast_collate,
+        **worker_kwargs
     )
+    valid_loader = PrefetchLoader(valid_loader, IMAGE_MEAN, IMAGE_STD)
+
+    # float16 needs loss scaling; a disabled scaler is a pass-through
+    scaler = torch.amp.GradScaler(
+        'cuda', enabled=config.TRAIN.AMP_DTYPE == 'float16')
+
+    graphed_step = None
+    if config.TRAIN.CUDA_GRAPH:
+        # GradScaler syncs with the host every step, which capture forbids
+        if scaler.is_enabled():
+            raise ValueError("TRAIN.CUDA_GRAPH does not support float16 AMP")
+        # max-autotune already replays compiled regions as CUDA graphs
+        if config.TRAIN.COMPILE:
+            raise ValueError("TRAIN.CUDA_GRAPH does not support TRAIN.COMPILE")
+        # The captured step always ends in optimizer.step()
+        if accum_steps > 1:
+            raise ValueError("TRAIN.CUDA_GRAPH does not support ACCUM_STEPS")
+        graphed_step = GraphedTrainStep(
+            model, criterion, optimizer, amp_dtype=get_amp_dtype(config))
+
+    model_name = get_model_name(config)
+
+    def make_save_dict(epoch_i, perf):
+        # Snapshotted to the CPU since the next epoch starts before the
+        # background save is done with it
+        return {
+            'epoch_i': epoch_i + 1,
+            'model': model_name,
+            'state_dict': cpu_snapshot(model.module.state_dict()),
+            'perf': perf,
+            'optimizer': cpu_snapshot(optimizer.state_dict()),
+        }
+
+    # Checkpoints are written on one background thread, in order, while
+    # training moves on to the next epoch
+    saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending_save = None
 
     print("Training model...")
     best_perf = 0.0
     best_model = False
     for epoch_i in range(config.TRAIN.BEGIN_EPOCH, config.TRAIN.END_EPOCH):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch_i)
+
         # train for one epoch
         train(
             config, 
@@ -180,49 +298,73 @@ def main():
             optimizer, 
             epoch_i,
             output_dir,
+            scaler=scaler,
+            graphed_step=graphed_step,
         )
 
         lr_scheduler.step()
 
-        # evaluate on validation set
-        perf_indicator = validate(
-            config, 
-            valid_loader, 
-            valid_dataset, 
-            model,
-            criterion, 
+        # Validation needs predictions for the whole set, so only rank 0
+        # evaluates and checkpoints; the other ranks wait at the barrier
+        if rank == 0:
+            # evaluate on validation set
+            perf_indicator = validate(
+                config, 
+                valid_loader, 
+                valid_dataset, 
+                model.module,
+                criterion, 
+                output_dir,
+            )
+
+            if perf_indicator > best_perf:
+                best_perf = perf_indicator
+                best_model = True
+            else:
+                best_model = False
+
+            # Surface a failure from the previous save before queueing more
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = saver.submit(
+                save_checkpoint,
+                make_save_dict(epoch_i, perf_indicator),
+                best_model,
+                output_dir,
+            )
+        dist.barrier()
+
+    # Final ckpt save
+    if rank == 0:
+        if pending_save is not None:
+            pending_save.result()
+        pending_save = saver.submit(
+            save_checkpoint,
+            make_save_dict(epoch_i, perf_indicator),
+            False,
             output_dir,
+            filename='final_state.pth.tar'
         )
+        saver.shutdown(wait=True)
+        pending_save.result()
 
-        if perf_indicator > best_perf:
-            best_perf = perf_indicator
-            best_model = True
-        else:
-            best_model = False
+    dist.destroy_process_group()
 
-        save_dict = {
-            'epoch_i': epoch_i + 1,
-            'model': get_model_name(config),
-            'state_dict': model.module.state_dict(),
-            'perf': perf_indicator,
-            'optimizer': optimizer.state_dict(),
-        }
-        save_checkpoint(save_dict, best_model, output_dir)
 
-    # Final ckpt save
-    save_dict = {
-        'epoch_i': epoch_i + 1,
-        'model': get_model_name(config),
-        'state_dict': model.module.state_dict(),
-        'perf': perf_indicator,
-        'optimizer': optimizer.state_dict(),
-    }
-    save_checkpoint(
-        save_dict, 
-        False, 
-        output_dir, 
-        filename='final_state.pth.tar'
-    )
+def main():
+    args = parse_args()
+    reset_config(config, args)
+
+    gpus = [int(i) for i in config.GPUS.split(',')]
+    print(f"GPUS: {gpus}")
+
+    # One process per GPU; rendezvous on this host unless told otherwise
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    if config.TRAIN.CUDA_GRAPH:
+        # Capturing DDP's collectives requires NCCL async error handling off
+        os.environ.setdefault('TORCH_NCCL_ASYNC_ERROR_HANDLING', '0')
+    mp.spawn(main_worker, nprocs=len(gpus), args=(gpus, args))
 
 
 if __name__ == '__main__':
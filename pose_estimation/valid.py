@@ -180,6 +180,10 @@ def main():
     # Load previous model
     model.load_state_dict(state_dict)
 
+    # Fold BatchNorms into their convs for inference
+    model.eval()
+    model.fuse()
+
     gpus = [int(i) for i in config.GPUS.split(',')]
     model = torch.nn.DataParallel(model, device_ids=gpus).cuda()
 
@@ -191,7 +195,7 @@ def main():
     # Data loading code
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
-    valid_dataset = eval('dataset.'+config.DATASET.DATASET)(
+    valid_dataset = dataset.DATASETS[config.DATASET.DATASET](
         config,
         config.DATASET.ROOT,
         config.DATASET.TEST_SET,